@@ -1,19 +1,26 @@
 import streamlit as st
 import os
 import json
-import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
+import re
+import msgspec
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
 import requests  # Keep requests for making API calls
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from urllib3.util.retry import Retry
 from datetime import datetime
+from typing import Optional
 
 # Page configuration
 st.set_page_config(page_title="X Analyzer: Financial Assistant Chatbot", page_icon="💰", layout="wide")
 
-# Add Company Name and Logo
-st.markdown(
-    """
-    <style>
+# Styles: shared rules plus the rules for each theme, emitted as a single block
+BASE_CSS = """
     .title {
         text-align: center;
         font-size: 40px;
@@ -31,50 +38,47 @@ st.markdown(
         font-size: 24px;
         font-weight: bold;
     }
-    </style>
-    """, unsafe_allow_html=True
-)
+"""
+
+DAY_CSS = """
+    body {
+        background-color: #f4f4f9;
+        color: #333;
+    }
+    .title {
+        color: #4CAF50;
+    }
+    .subtitle {
+        color: #777;
+    }
+"""
+
+NIGHT_CSS = """
+    body {
+        background-color: #2C2C2C;
+        color: white;
+    }
+    .title {
+        color: #ff9800;
+    }
+    .subtitle {
+        color: #ccc;
+    }
+"""
 
+THEMES = {
+    "Day Mode": {"template": "plotly_white", "css": f"<style>{BASE_CSS}{DAY_CSS}</style>"},
+    "Night Mode": {"template": "plotly_dark", "css": f"<style>{BASE_CSS}{NIGHT_CSS}</style>"},
+}
+
+# Add Company Name and Logo
 st.markdown('<p class="title">X Analyzer: Financial Assistant Chatbot</p>', unsafe_allow_html=True)
 st.markdown('<p class="subtitle">Providing financial insights and visual analysis for smarter decisions.</p>', unsafe_allow_html=True)
 
 # Theme: Day/Night Mode Toggle
-theme = st.selectbox("Choose Theme", ["Day Mode", "Night Mode"])
-
-if theme == "Day Mode":
-    st.markdown(
-        """
-        <style>
-        body {
-            background-color: #f4f4f9;
-            color: #333;
-        }
-        .title {
-            color: #4CAF50;
-        }
-        .subtitle {
-            color: #777;
-        }
-        </style>
-        """, unsafe_allow_html=True
-    )
-else:
-    st.markdown(
-        """
-        <style>
-        body {
-            background-color: #2C2C2C;
-            color: white;
-        }
-        .title {
-            color: #ff9800;
-        }
-        .subtitle {
-            color: #ccc;
-        }
-        </style>
-        """, unsafe_allow_html=True
-    )
+theme = st.selectbox("Choose Theme", list(THEMES))
+
+st.markdown(THEMES[theme]["css"], unsafe_allow_html=True)
 
 # Initialize Groq Client (Directly use `requests` here)
 if "groq_client" not in st.session_state:
@@ -85,101 +89,605 @@ if "groq_client" not in st.session_state:
         st.info("Please enter your Groq API key in the sidebar to start chatting.")
         st.stop()
 
+# Model tier: trade answer quality for latency (Groq no longer serves the 70b specdec variant)
+MODEL_TIERS = {
+    "instant": "llama-3.1-8b-instant",
+    "balanced": "llama-3.3-70b-versatile",
+}
+speed_tier = st.sidebar.selectbox("Speed tier", list(MODEL_TIERS), index=1)
+
+# Reuse one pooled keep-alive session across reruns to skip TCP/TLS handshakes
+if "http" not in st.session_state:
+    http = requests.Session()
+    http.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=2,
+            read=0,  # Never resend a completion after a read timeout; it may already be generated and billed
+            backoff_factor=0.3,
+            # 429 is not retried here: groq_stream fails over to the instant tier at once instead.
+            # Retry-After is ignored because urllib3 sleeps for the full header value (uncapped,
+            # and not bounded by the request timeout), which could stall the script for minutes.
+            status_forcelist=[500, 502, 503, 504],
+            respect_retry_after_header=False,
+            allowed_methods=None,  # Also retry POST
+            raise_on_status=False,
+        ),
+    ))
+    st.session_state.http = http
+
 # Initialize Chat History
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-    st.session_state.messages.append({
-        "role": "system",
-        "content": """You are a helpful financial assistant. Provide advice on budgeting, saving, investing, and personal finance. 
-        When users provide financial data (like expenses, income, budgets, investments), respond with both advice AND a JSON object 
-        for visualization. Format: {"chart_type": "pie|bar|line", "title": "Chart Title", "data": {"labels": [], "values": []}}
-        Always remind users to consult with licensed financial advisors for important decisions."""
-    })
+# Kept short and byte-identical across turns so provider-side prefix caching can reuse it
+SYSTEM_PROMPT = (
+    "You are a financial assistant for budgeting, saving and investing. "
+    "When given financial figures, also reply with chart JSON: "
+    '{"chart_type": "pie|bar|line", "title": "", "data": {"labels": [], "values": []}}. '
+    "Recommend licensed advisors for major decisions."
+)
+MAX_TURNS = 8  # previous user/assistant exchanges sent with each new prompt
+MAX_CONTEXT_TOKENS = 6000  # estimated prompt tokens sent with each request
+
+
+# Chat history is stored as parallel role/content lists; the Groq payload is only built
+# at send time. A rolling digest hashes each message once when appended, so cache keys
+# never require re-serializing the whole conversation
+def reset_history():
+    st.session_state.roles = []
+    st.session_state.contents = []
+    st.session_state.hasher = hashlib.blake2b()
+    append_message("system", SYSTEM_PROMPT)
+
+
+def hash_message(hasher, role, content):
+    hasher.update(json.dumps([role, content]).encode())
+
+
+def append_message(role, content):
+    st.session_state.roles.append(role)
+    st.session_state.contents.append(content)
+    hash_message(st.session_state.hasher, role, content)
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1  # ~4 characters per token for English text
+
+
+def history_window(roles, contents):
+    """Return the system prompt plus the newest prompt and as many of the last MAX_TURNS exchanges
+    as fit in MAX_CONTEXT_TOKENS, as (role, content) pairs."""
+    oldest = max(1, len(roles) - (MAX_TURNS * 2 + 1))
+    budget = MAX_CONTEXT_TOKENS - estimate_tokens(contents[0]) - estimate_tokens(contents[-1])
+    start = len(roles) - 1
+    while start > oldest:
+        budget -= estimate_tokens(contents[start - 1])
+        if budget < 0:
+            break
+        start -= 1
+    return ((roles[0], contents[0]),) + tuple(zip(roles[start:], contents[start:]))
+
+
+if "roles" not in st.session_state:
+    reset_history()
+
+# Response cache for Groq completions (shared across reruns and sessions)
+GROQ_API = "https://api.groq.com/openai/v1"
+GROQ_URL = f"{GROQ_API}/chat/completions"
+GROQ_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+TEMPERATURE = 0.7
+MAX_TOKENS = 1024
+FALLBACK_MODEL = MODEL_TIERS["instant"]
+FALLBACK_STATUSES = {429, 500, 502, 503, 504}
+FALLBACK_ERROR_CODES = {"model_not_found", "model_decommissioned"}  # Sent with 400/404 for retired models
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 300  # seconds
+DISK_CACHE_PATH = ".groq_cache.sqlite3"
+DISK_CACHE_TTL = 86400  # seconds
+
+
+@st.cache_resource
+def get_response_cache():
+    return {"entries": OrderedDict(), "lock": threading.Lock()}
+
+
+@st.cache_resource
+def init_disk_cache():
+    # Runs once per process: create the table and drop rows that expired while the app was down
+    with closing(sqlite3.connect(DISK_CACHE_PATH, timeout=5)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, expires REAL)")
+        conn.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+    return DISK_CACHE_PATH
+
+
+def disk_cache_connect():
+    return sqlite3.connect(init_disk_cache(), timeout=5)
+
+
+def disk_cache_get(key):
+    with closing(disk_cache_connect()) as conn:
+        row = conn.execute("SELECT response, expires FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is not None and row[1] > time.time():
+        return json.loads(row[0])
+    return None
+
+
+def disk_cache_set(key, assistant_message, expire=DISK_CACHE_TTL):
+    now = time.time()
+    with closing(disk_cache_connect()) as conn, conn:
+        # Expiry is only checked on read, so cull stale rows here to keep the file bounded
+        conn.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(assistant_message), now + expire),
+        )
+
+
+def clear_response_cache():
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["entries"].clear()
+    with closing(disk_cache_connect()) as conn, conn:
+        conn.execute("DELETE FROM responses")
+
+
+def remember_response(key, assistant_message):
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["entries"][key] = (time.monotonic() + RESPONSE_CACHE_TTL, assistant_message)
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > RESPONSE_CACHE_SIZE:
+            cache["entries"].popitem(last=False)
+
+
+def response_cache_key(hasher, model, temp, max_tokens):
+    h = hasher.copy()
+    h.update(json.dumps([model, temp, max_tokens]).encode())
+    return h.hexdigest()
+
+
+def lookup_response(key):
+    cache = get_response_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            cache["entries"].move_to_end(key)
+            return entry[1]
+
+    # Fall back to the persistent cache, which survives restarts and redeploys
+    assistant_message = disk_cache_get(key)
+    if assistant_message is not None:
+        remember_response(key, assistant_message)
+    return assistant_message
+
+
+def model_unavailable(response):
+    if response.status_code not in (400, 404):
+        return False
+    try:
+        error = response.json().get("error") or {}
+    except ValueError:
+        return False
+    return isinstance(error, dict) and error.get("code") in FALLBACK_ERROR_CODES
+
+
+def groq_stream(key, messages_tuple, model, temp, max_tokens, status=None):
+    """Yield the assistant reply for the given (role, content) pairs as it streams in, using the cache entry `key` when possible.
+
+    If `status` is a dict, status["fallback"] is set to whether the reply came from FALLBACK_MODEL.
+    """
+    if status is None:
+        status = {}
+    status["fallback"] = False
+    assistant_message = lookup_response(key)
+    if assistant_message is not None:
+        yield assistant_message
+        return
+
+    headers = {
+        'Authorization': f'Bearer {st.session_state.groq_client_api_key}',  # Use the stored API key
+        'Content-Type': 'application/json',
+    }
+
+    data = {
+        "model": model,
+        "messages": [{"role": role, "content": content} for role, content in messages_tuple],
+        "temperature": temp,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+
+    try:
+        response = st.session_state.http.post(GROQ_URL, json=data, headers=headers, timeout=GROQ_TIMEOUT, stream=True)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        if model == FALLBACK_MODEL:
+            raise
+        response = None
+
+    # Timed out, unreachable, retired, or still rate limited/failing after the adapter's retries:
+    # answer from the instant tier rather than erroring out on the requested model
+    fallback = model != FALLBACK_MODEL and (
+        response is None or response.status_code in FALLBACK_STATUSES or model_unavailable(response)
+    )
+    if fallback:
+        if response is not None:
+            response.close()
+        data["model"] = FALLBACK_MODEL
+        response = st.session_state.http.post(GROQ_URL, json=data, headers=headers, timeout=GROQ_TIMEOUT, stream=True)
+    status["fallback"] = fallback
+
+    parts = []
+    with response:
+        if response.status_code != 200:
+            response_data = response.json()
+            raise RuntimeError(f"{response.status_code} - {response_data.get('error', 'Unknown error')}")
+
+        # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            payload = line[len(b"data: "):]
+            if payload == b"[DONE]":
+                break
+            delta = json.loads(payload)['choices'][0]['delta'].get('content')
+            if delta:
+                parts.append(delta)
+                yield delta
+
+    # Fallback answers come from a different model, so they are not cached under this key
+    if not fallback:
+        assistant_message = "".join(parts)
+        remember_response(key, assistant_message)
+        disk_cache_set(key, assistant_message)
+
+
+# Speculative prefetch: after each reply, warm the response cache for the likely next prompts
+EXAMPLE_PROMPTS = [
+    "I spend $500 on rent, $300 on groceries, $150 on utilities, $100 on entertainment",
+    "My monthly income is $3000 from salary, $500 from freelance",
+    "Show my investment portfolio: $5000 in stocks, $3000 in bonds, $2000 in crypto",
+]
+FOLLOW_UP_PROMPTS = ["Explain that in more detail."] + EXAMPLE_PROMPTS  # Most likely first
+PREFETCH_JOBS_PER_TURN = 1  # Keep background calls from eating the rate limit the next real turn needs
+PREFETCH_TOKEN_BUDGET = 8192  # estimated prompt + completion tokens spent on prefetches per session
+
+
+def groq_fetch(http, api_key, messages_tuple, model, temp, max_tokens):
+    """Return the complete (non-streamed) assistant reply; safe to call outside the script thread."""
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+    }
+
+    data = {
+        "model": model,
+        "messages": [{"role": role, "content": content} for role, content in messages_tuple],
+        "temperature": temp,
+        "max_tokens": max_tokens,
+    }
+
+    response = http.post(GROQ_URL, json=data, headers=headers, timeout=GROQ_TIMEOUT)
+    response_data = response.json()
+
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} - {response_data.get('error', 'Unknown error')}")
+    return response_data['choices'][0]['message']['content']
+
+
+def prefetch_worker(http, api_key, jobs, model):
+    for key, messages_tuple in jobs:
+        try:
+            assistant_message = groq_fetch(http, api_key, messages_tuple, model, TEMPERATURE, MAX_TOKENS)
+            remember_response(key, assistant_message)
+            disk_cache_set(key, assistant_message)
+        except Exception:
+            continue  # Prefetching is best effort (network errors, rate limits, a locked cache file)
+
+
+def start_prefetch(model):
+    if "prefetch_budget" not in st.session_state:
+        st.session_state.prefetch_budget = PREFETCH_TOKEN_BUDGET
+
+    jobs = []
+    for follow_up in FOLLOW_UP_PROMPTS:
+        if len(jobs) >= PREFETCH_JOBS_PER_TURN:
+            break
+        hasher = st.session_state.hasher.copy()
+        hash_message(hasher, "user", follow_up)
+        key = response_cache_key(hasher, model, TEMPERATURE, MAX_TOKENS)
+        if lookup_response(key) is not None:
+            continue
+        window = history_window(st.session_state.roles + ["user"], st.session_state.contents + [follow_up])
+        cost = sum(estimate_tokens(content) for _, content in window) + MAX_TOKENS
+        if cost > st.session_state.prefetch_budget:
+            continue
+        jobs.append((key, window))
+        st.session_state.prefetch_budget -= cost
+
+    if jobs:
+        thread = threading.Thread(
+            target=prefetch_worker,
+            args=(st.session_state.http, st.session_state.groq_client_api_key, jobs, model),
+            daemon=True,
+        )
+        add_script_run_ctx(thread)  # Lets the worker reach the st.cache_resource response cache
+        thread.start()
+
+
+# Batch regeneration: re-answer every user turn through the Groq Batch API (cheaper, no
+# per-minute rate limits). When the batch finishes, the new answers replace the old ones in
+# the chat and the history digest is rebuilt, so the chat and the response cache agree
+BATCH_POLL_INTERVAL = "30s"
+BATCH_TERMINAL_STATUSES = ("failed", "expired", "cancelled")
+
+
+def submit_batch(model):
+    """Upload one chat completion request per answered user turn; return the batch id and its context."""
+    lines = []
+    roles, contents = st.session_state.roles, st.session_state.contents
+    for i, role in enumerate(roles[:-1]):
+        if role != "user" or roles[i + 1] != "assistant":
+            continue
+        lines.append(json.dumps({
+            "custom_id": f"turn-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [{"role": r, "content": c} for r, c in history_window(roles[:i + 1], contents[:i + 1])],
+                "temperature": TEMPERATURE,
+                "max_tokens": MAX_TOKENS,
+            },
+        }))
+    if not lines:
+        raise RuntimeError("There are no answered user messages to regenerate.")
+
+    http = st.session_state.http
+    headers = {'Authorization': f'Bearer {st.session_state.groq_client_api_key}'}
+
+    response = http.post(
+        f"{GROQ_API}/files",
+        headers=headers,
+        data={"purpose": "batch"},
+        files={"file": ("regenerate.jsonl", "\n".join(lines).encode())},
+        timeout=GROQ_TIMEOUT,
+    )
+    response_data = response.json()
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} - {response_data.get('error', 'Unknown error')}")
+
+    response = http.post(
+        f"{GROQ_API}/batches",
+        headers=headers,
+        json={"input_file_id": response_data["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"},
+        timeout=GROQ_TIMEOUT,
+    )
+    response_data = response.json()
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} - {response_data.get('error', 'Unknown error')}")
+
+    # Remember which history the answers belong to, so they are only applied to that chat
+    context = {"model": model, "length": len(roles), "digest": st.session_state.hasher.hexdigest()}
+    return response_data["id"], context
+
+
+def apply_batch_answers(context, answers):
+    """Replace assistant answers with the regenerated ones (keyed by user turn index) and
+    re-key the response cache on the new history. Return the number of answers replaced."""
+    roles, contents = st.session_state.roles, st.session_state.contents
+    length = context["length"]
+
+    hasher = hashlib.blake2b()
+    for role, content in zip(roles[:length], contents[:length]):
+        hash_message(hasher, role, content)
+    if len(roles) < length or hasher.hexdigest() != context["digest"]:
+        raise RuntimeError("The chat changed since the batch was submitted; its answers were discarded.")
+
+    hasher = hashlib.blake2b()
+    replaced = 0
+    for i, role in enumerate(roles):
+        if role == "assistant" and i - 1 in answers:
+            contents[i] = answers[i - 1]
+            # hasher covers the history up to the user turn, i.e. the live key for this answer
+            key = response_cache_key(hasher, context["model"], TEMPERATURE, MAX_TOKENS)
+            remember_response(key, contents[i])
+            disk_cache_set(key, contents[i])
+            replaced += 1
+        hash_message(hasher, role, contents[i])
+    st.session_state.hasher = hasher
+    return replaced
+
+
+def finish_batch(kind, text):
+    # Dropping batch_id and rerunning the app stops the polling fragment's timer
+    del st.session_state.batch_id
+    del st.session_state.batch_context
+    st.session_state.batch_notice = (kind, text)
+    st.rerun(scope="app")
+
+
+@st.fragment(run_every=BATCH_POLL_INTERVAL)
+def poll_batch():
+    batch_id = st.session_state.batch_id
+    http = st.session_state.http
+    headers = {'Authorization': f'Bearer {st.session_state.groq_client_api_key}'}
+
+    try:
+        response = http.get(f"{GROQ_API}/batches/{batch_id}", headers=headers, timeout=GROQ_TIMEOUT)
+        if response.status_code == 200:
+            batch = response.json()
+            status = batch.get("status")
+            if status == "completed" and batch.get("output_file_id"):
+                response = http.get(f"{GROQ_API}/files/{batch['output_file_id']}/content", headers=headers, timeout=GROQ_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        st.caption(f"Batch regeneration: status check failed ({e}); retrying.")
+        return
+
+    # finish_batch() reruns the app, so nothing after it in this run executes
+    if response.status_code != 200:
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            finish_batch("error", f"Batch regeneration dropped: {response.status_code} - {response.text[:200]}")
+        else:  # 429/5xx are transient: keep the batch and poll again
+            st.caption(f"Batch regeneration: status check failed ({response.status_code}); retrying.")
+        return
+    if status in BATCH_TERMINAL_STATUSES:
+        finish_batch("error", f"Batch regeneration {status}.")
+    elif status != "completed":
+        st.caption(f"Batch regeneration: {status}")
+        return
+    elif not batch.get("output_file_id"):
+        # A batch whose requests all failed completes with only an error file
+        finish_batch("error", "Batch regeneration completed without any answers.")
+
+    answers = {}
+    try:
+        for line in response.text.splitlines():
+            result = json.loads(line)
+            body = (result.get("response") or {}).get("body") or {}
+            if body.get("choices") and result.get("custom_id", "").startswith("turn-"):
+                answers[int(result["custom_id"][len("turn-"):])] = body['choices'][0]['message']['content']
+    except (ValueError, KeyError, IndexError) as e:
+        finish_batch("error", f"Batch regeneration returned unreadable output: {str(e)}")
+    if not answers:
+        finish_batch("error", "Batch regeneration completed without any answers.")
+
+    try:
+        replaced = apply_batch_answers(st.session_state.batch_context, answers)
+    except Exception as e:
+        finish_batch("error", f"Error: {str(e)}")
+    else:
+        finish_batch("success", f"Batch regeneration replaced {replaced} answers in this chat and cached them.")
+
+
+# Braces and whole JSON string literals; strings are matched (and skipped) in C so
+# braces inside titles or labels do not affect the depth count
+JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}]', re.DOTALL)
+
+
+# Function to find the first balanced {...} span in a single pass
+def find_json_span(text):
+    start = text.find('{')
+    if start == -1:
+        return None
+    depth = 0
+    for match in JSON_TOKEN_RE.finditer(text, start):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return start, match.end()
+    return None
+
+
+# Fixed schema of the chart JSON requested in SYSTEM_PROMPT; decoding straight into
+# these structs skips building a generic dict for every key
+class DataSchema(msgspec.Struct):
+    labels: list
+    values: list[float]
+
+
+class VizSchema(msgspec.Struct):
+    chart_type: Optional[str] = "bar"
+    title: Optional[str] = "Financial Analysis"
+    data: Optional[DataSchema] = None
+
+
+# strict=False coerces numeric strings such as "500" in values, which models often emit
+VIZ_DECODER = msgspec.json.Decoder(VizSchema, strict=False)
+
+
+# Function to extract chart data from a response as (chart_type, title, labels, values),
+# or None if there is nothing to plot
+@st.cache_data(max_entries=256)
+def parse_visualization(text):
+    span = find_json_span(text)
+    if span is None:
+        return None
+    try:
+        viz = VIZ_DECODER.decode(text[span[0]:span[1]].encode())
+    except msgspec.ValidationError:
+        return None  # Valid JSON, but not chart data
+    if viz.data is None:
+        return None
+    if len(viz.data.labels) != len(viz.data.values):
+        raise ValueError("Chart labels and values must be the same length.")
+    return viz.chart_type or "bar", viz.title or "Financial Analysis", viz.data.labels, viz.data.values
+
+
+# Function to build the Plotly figure for parsed chart data (memoized across reruns)
+@st.cache_data(max_entries=64)  # Pickled figures are ~5 KB and only slightly cheaper than rebuilding
+def build_figure(chart, theme):
+    import plotly.graph_objects as go  # Imported on first chart to keep cold starts fast
+
+    chart_type, title, labels, values = chart
+
+    if chart_type == "pie":
+        fig = go.Figure(go.Pie(labels=labels, values=values))
+    elif chart_type == "line":
+        fig = go.Figure(go.Scatter(x=labels, y=values, mode="lines+markers"))
+    else:  # bar
+        fig = go.Figure(go.Bar(x=labels, y=values))
+
+    # Customizations for better visual appeal
+    fig.update_layout(
+        template=THEMES[theme]["template"],
+        title=title,
+        title_font=dict(size=24),
+        xaxis_title='Category',
+        yaxis_title='Amount'
+    )
+    return fig
+
 
 # Function to extract and visualize data
 def create_visualization(text):
     try:
-        # Try to extract JSON from response
-        start = text.find('{')
-        end = text.rfind('}') + 1
-        if start != -1 and end > start:
-            json_str = text[start:end]
-            data = json.loads(json_str)
-
-            chart_type = data.get("chart_type", "bar")
-            title = data.get("title", "Financial Analysis")
-            chart_data = data.get("data", {})
-
-            if "labels" in chart_data and "values" in chart_data:
-                df = pd.DataFrame({
-                    'Category': chart_data['labels'],
-                    'Amount': chart_data['values']
-                })
-
-                st.subheader(f"📊 {title}")
-
-                if chart_type == "pie":
-                    fig = px.pie(df, names='Category', values='Amount', title=title)
-                elif chart_type == "line":
-                    fig = px.line(df, x='Category', y='Amount', title=title, markers=True)
-                else:  # bar
-                    fig = px.bar(df, x='Category', y='Amount', title=title)
-
-                # Customizations for better visual appeal
-                fig.update_layout(
-                    template="plotly_dark" if theme == "Night Mode" else "plotly_white",
-                    title_font=dict(size=24),
-                    xaxis_title='Category',
-                    yaxis_title='Amount'
-                )
-
-                st.plotly_chart(fig, use_container_width=True)
-                return True
+        chart = parse_visualization(text)
+        if chart:
+            st.subheader(f"📊 {chart[1]}")
+            st.plotly_chart(build_figure(chart, theme), use_container_width=True, theme=None)
+            return True
     except Exception as e:
         st.error(f"Error creating visualization: {str(e)}")
     return False
 
 
 # Display chat history (excluding system message)
-for message in st.session_state.messages[1:]:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
-        if message["role"] == "assistant":
-            create_visualization(message["content"])
+@st.fragment
+def render_history():
+    for role, content in zip(st.session_state.roles[1:], st.session_state.contents[1:]):
+        with st.chat_message(role):
+            st.markdown(content)
+            if role == "assistant":
+                create_visualization(content)
+
+
+render_history()
 
 # Chat input
 if prompt := st.chat_input("Ask me about budgeting, savings, investments..."):
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    append_message("user", prompt)
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
         try:
-            headers = {
-                'Authorization': f'Bearer {st.session_state.groq_client_api_key}',  # Use the stored API key
-                'Content-Type': 'application/json',
-            }
-
-            data = {
-                "model": "llama-3.3-70b-versatile",
-                "messages": st.session_state.messages,
-                "temperature": 0.7,
-                "max_tokens": 1024,
-            }
-
-            response = requests.post("https://api.groq.com/openai/v1/chat/completions", json=data, headers=headers)
-            response_data = response.json()
-
-            if response.status_code == 200:
-                assistant_message = response_data['choices'][0]['message']['content']
-                st.markdown(assistant_message)
-
-                # Try to create visualization
-                create_visualization(assistant_message)
-
-                st.session_state.messages.append({"role": "assistant", "content": assistant_message})
-            else:
-                st.error(f"Error: {response.status_code} - {response_data.get('error', 'Unknown error')}")
+            messages_tuple = history_window(st.session_state.roles, st.session_state.contents)
+            model = MODEL_TIERS[speed_tier]
+            key = response_cache_key(st.session_state.hasher, model, TEMPERATURE, MAX_TOKENS)
+            stream_status = {}
+            assistant_message = st.write_stream(groq_stream(key, messages_tuple, model, TEMPERATURE, MAX_TOKENS, stream_status))
+            if stream_status["fallback"]:
+                st.caption(f"{model} was unavailable, so this answer came from {FALLBACK_MODEL}.")
+
+            # Try to create visualization
+            create_visualization(assistant_message)
+
+            append_message("assistant", assistant_message)
+            # Don't add background load to a model that just timed out or rate limited us
+            if not stream_status["fallback"]:
+                start_prefetch(model)
         except Exception as e:
             st.error(f"Error: {str(e)}")
 
@@ -187,17 +695,25 @@ if prompt := st.chat_input("Ask me about budgeting, savings, investments..."):
 with st.sidebar:
     st.header("Options")
     if st.button("Clear Chat History"):
-        st.session_state.messages = [st.session_state.messages[0]]  # Keep system message
+        reset_history()  # Keep system message
         st.rerun()
+    if st.button("Clear response cache"):
+        clear_response_cache()
+    if st.button("Regenerate all answers (batch)"):
+        try:
+            st.session_state.batch_id, st.session_state.batch_context = submit_batch(MODEL_TIERS[speed_tier])
+        except Exception as e:
+            st.error(f"Error: {str(e)}")
+    if "batch_notice" in st.session_state:
+        kind, text = st.session_state.pop("batch_notice")
+        getattr(st, kind)(text)
+    # Only sessions with a batch in flight run the 30 s polling fragment
+    if "batch_id" in st.session_state:
+        poll_batch()
 
     st.markdown("---")
     st.markdown("### 📊 Visualization Examples")
-    st.markdown("""
-    Try these prompts:
-    - "I spend $500 on rent, $300 on groceries, $150 on utilities, $100 on entertainment"
-    - "My monthly income is $3000 from salary, $500 from freelance"
-    - "Show my investment portfolio: $5000 in stocks, $3000 in bonds, $2000 in crypto"
-    """)
+    st.markdown("Try these prompts:\n" + "\n".join(f'- "{example}"' for example in EXAMPLE_PROMPTS))
 
     st.markdown("---")
     st.markdown("### About")
@@ -207,36 +723,39 @@ with st.sidebar:
     """)
 
 # Canvas Mode for Custom Chart Drawing
-canvas_mode = st.checkbox("Enable Canvas Mode")
-
-if canvas_mode:
-    st.markdown("### Canvas Mode Activated")
-    st.markdown("You can now add custom data points to visualize with charts.")
-    
-    # Collect Data for Custom Visualization
-    categories = st.text_area("Enter categories (comma-separated, e.g., Rent, Groceries, Utilities):")
-    amounts = st.text_area("Enter corresponding amounts (comma-separated, e.g., 500, 300, 150):")
-
-    if categories and amounts:
-        try:
-            # Clean and split categories and amounts
-            categories = [category.strip() for category in categories.split(",")]
-            amounts = [amount.strip() for amount in amounts.split(",")]
-
-            # Convert amounts to float
-            amounts = list(map(float, amounts))  # Convert each amount to float
-
-            # Ensure the number of categories matches the number of amounts
-            if len(categories) == len(amounts):
-                df = pd.DataFrame({
-                    'Category': categories,
-                    'Amount': amounts
-                })
-
-                # Display the custom bar chart
-                fig = px.bar(df, x='Category', y='Amount', title="Custom Financial Chart")
-                st.plotly_chart(fig)
-            else:
-                st.error("The number of categories and amounts must be the same.")
-        except ValueError as e:
-            st.error(f"Error: {str(e)}. Please make sure amounts are numeric values.")
+@st.fragment
+def render_canvas():
+    canvas_mode = st.checkbox("Enable Canvas Mode")
+
+    if canvas_mode:
+        st.markdown("### Canvas Mode Activated")
+        st.markdown("You can now add custom data points to visualize with charts.")
+
+        # Collect Data for Custom Visualization
+        categories = st.text_area("Enter categories (comma-separated, e.g., Rent, Groceries, Utilities):")
+        amounts = st.text_area("Enter corresponding amounts (comma-separated, e.g., 500, 300, 150):")
+
+        if categories and amounts:
+            import numpy as np
+            import plotly.graph_objects as go
+
+            try:
+                # Clean and split categories
+                categories = [category.strip() for category in categories.split(",")]
+
+                # Convert all amounts to float in one vectorized pass (raises ValueError on bad input)
+                amounts = np.array(amounts.split(","), dtype=np.float64)
+
+                # Ensure the number of categories matches the number of amounts
+                if amounts.size == len(categories):
+                    # Display the custom bar chart
+                    fig = go.Figure(go.Bar(x=categories, y=amounts))
+                    fig.update_layout(title="Custom Financial Chart", xaxis_title='Category', yaxis_title='Amount')
+                    st.plotly_chart(fig)
+                else:
+                    st.error("The number of categories and amounts must be the same.")
+            except ValueError as e:
+                st.error(f"Error: {str(e)}. Please make sure amounts are numeric values.")
+
+
+render_canvas()